@@ -1,8 +1,11 @@
+import multiprocessing as mp
 import os
+import time
+import numpy as np
 import pandas as pd
+import xlsxwriter
 import yfinance as yf
-from openpyxl import load_workbook
-from openpyxl.styles import PatternFill
+from numba import njit
 
 # -----------------------------
 # Config
@@ -19,37 +22,58 @@ interval = "1h"
 
 initial_capital = 100000  # Starting capital
 
+cache_max_age = 24 * 60 * 60  # Re-download cached data older than this (seconds)
+export_clean_xlsx = False  # Also write clean data as .xlsx for manual inspection
+
+# Highlight styles (xlsxwriter formats are per-workbook, so only the properties are shared)
+green_fill = {"bg_color": "#99FF99"}
+red_fill = {"bg_color": "#FF9999"}
+
+trend_dtype = pd.CategoricalDtype(
+    ["Upside Follow", "Upside Fake", "Downside Follow", "Downside Fake", "Neutral"]
+)
+
 # Ensure folders exist
 for folder in [download_dir, clean_dir, backtest_dir]:
     os.makedirs(folder, exist_ok=True)
 
+
 # -----------------------------
-# Load Tickers
+# Backtest Kernel
 # -----------------------------
-tickers_df = pd.read_excel(ticker_file)
-tickers = tickers_df.iloc[:, 0].dropna().tolist()
+@njit(cache=True)
+def run_backtest(entry, direction, last_close, cap0):
+    """Compound capital day by day; returns quantity, PnL and capital arrays."""
+    n = entry.shape[0]
+    qty = np.empty(n, np.int64)
+    pnl = np.empty(n)
+    cap = np.empty(n)
+    c = cap0
+    for i in range(n):
+        if direction[i] != 0.0 and not np.isnan(entry[i]):
+            q = int(c / entry[i])
+            p = direction[i] * (last_close[i] - entry[i]) * q
+        else:
+            q = 0
+            p = 0.0
+        c += p
+        qty[i] = q
+        pnl[i] = p
+        cap[i] = c
+    return qty, pnl, cap
 
-master_results = []
 
 # -----------------------------
-# Process Each Ticker
+# Per-Ticker Pipeline (clean + backtest + xlsx)
 # -----------------------------
-for symbol in tickers:
+def process_ticker(symbol, data):
+    """Clean, backtest and save one ticker; returns its Master Summary row or None."""
     try:
-        print(f"\n📥 Fetching data for {symbol}...")
-
-        # --- Download Data ---
-        data = yf.download(
-            symbol,
-            start=start_date,
-            end=end_date,
-            interval=interval,
-            auto_adjust=True
-        )
+        print(f"\n⚙️ Processing {symbol}...")
 
         if data.empty:
             print(f"⚠️ No data for {symbol}, skipping...")
-            continue
+            return None
 
         # Flatten columns if multi-index
         if isinstance(data.columns, pd.MultiIndex):
@@ -62,164 +86,234 @@ for symbol in tickers:
 
         # --- Clean Data ---
         data = data.reset_index()
-        data["Date"] = data["Datetime"].dt.date
+        # datetime64[D] keeps the groupby key int64-backed (dt.date would give Python objects)
+        data["Date"] = data["Datetime"].to_numpy().astype("datetime64[D]")
         data["Time"] = data["Datetime"].dt.time
         data = data[["Date", "Time", "Close", "High", "Low", "Open", "Volume"]]
 
-        clean_file = os.path.join(clean_dir, f"{symbol}_1H_Data_Clean.xlsx")
-        if os.path.exists(clean_file):
-            os.remove(clean_file)
-        data.to_excel(clean_file, index=False)
+        clean_file = os.path.join(clean_dir, f"{symbol}_1H_Data_Clean.parquet")
+        clean_tmp = clean_file + ".tmp"
+        data.to_parquet(clean_tmp, index=False, compression="snappy")
+        os.replace(clean_tmp, clean_file)  # atomic overwrite, no stat/unlink needed
         print(f"✅ Cleaned file saved → {clean_file}")
 
+        if export_clean_xlsx:
+            clean_xlsx = os.path.join(clean_dir, f"{symbol}_1H_Data_Clean.xlsx")
+            data.to_excel(clean_xlsx, index=False, engine="xlsxwriter")
+            print(f"✅ Cleaned Excel copy saved → {clean_xlsx}")
+
         # -----------------------------
         # Backtest with Compounded Capital & Quantity
         # -----------------------------
-        first_candles = data.groupby("Date").first().reset_index()
-        results = []
-        current_capital = initial_capital
-
-        for _, row in first_candles.iterrows():
-            day = row["Date"]
-            day_data = data[data["Date"] == day]
-
-            first_high = row["High"]
-            first_low = row["Low"]
-            last_close = day_data.iloc[-1]["Close"]
-
-            trend = "Neutral"
-            entry = None
-            exit_price = last_close
-            pnl = 0
-            invested_qty = 0
-
-            # Determine daily trade and quantity
-            if (day_data["High"] > first_high).any():
-                entry = first_high
-                invested_qty = int(current_capital / entry)
-                trend = "Upside Follow" if last_close > first_high else "Upside Fake"
-                pnl = (last_close - entry) * invested_qty
-
-            elif (day_data["Low"] < first_low).any():
-                entry = first_low
-                invested_qty = int(current_capital / entry)
-                trend = "Downside Follow" if last_close < first_low else "Downside Fake"
-                pnl = (entry - last_close) * invested_qty
-
-            current_capital += pnl  # update capital after trade
-
-            results.append({
-                "Date": day,
-                "Trend": trend,
-                "Entry": entry,
-                "Exit": exit_price,
-                "Quantity": invested_qty,
-                "PnL": pnl,
-                "Capital": current_capital
-            })
-
-        trend_df = pd.DataFrame(results)
-        final_capital = current_capital
+        agg = data.groupby("Date", sort=True).agg(
+            first_high=("High", "first"),
+            first_low=("Low", "first"),
+            day_high=("High", "max"),
+            day_low=("Low", "min"),
+            last_close=("Close", "last")
+        ).reset_index()
+
+        days = agg["Date"].to_numpy()
+        first_high = agg["first_high"].to_numpy(dtype=float)
+        first_low = agg["first_low"].to_numpy(dtype=float)
+        last_close = agg["last_close"].to_numpy(dtype=float)
+
+        # Determine daily trade direction (upside breakout takes priority)
+        up_mask = agg["day_high"].to_numpy() > first_high
+        down_mask = ~up_mask & (agg["day_low"].to_numpy() < first_low)
+
+        entry = np.where(up_mask, first_high, np.where(down_mask, first_low, np.nan))
+        direction = np.where(up_mask, 1.0, np.where(down_mask, -1.0, 0.0))
+        # Trend codes index into trend_dtype.categories
+        trend_codes = np.select(
+            [up_mask & (last_close > first_high), up_mask,
+             down_mask & (last_close < first_low), down_mask],
+            [0, 1, 2, 3],
+            default=4
+        )
+
+        # Compounding is sequential: quantity depends on capital after the previous day
+        qty, pnl, capital = run_backtest(
+            np.ascontiguousarray(entry),
+            np.ascontiguousarray(direction),
+            np.ascontiguousarray(last_close),
+            float(initial_capital)
+        )
+
+        trend_df = pd.DataFrame({
+            "Date": days,
+            "Trend": pd.Categorical.from_codes(trend_codes, dtype=trend_dtype),
+            "Entry": entry,
+            "Exit": last_close,
+            "Quantity": qty,
+            "PnL": pnl,
+            "Capital": capital
+        })
+        final_capital = capital[-1] if len(capital) else initial_capital
         total_profit = final_capital - initial_capital
 
-        summary = trend_df["Trend"].value_counts().to_dict()
+        counts = trend_df["Trend"].value_counts().reindex(trend_dtype.categories, fill_value=0).tolist()
+        upside_follow, upside_fake, downside_follow, downside_fake, _ = counts
         total_trades = len(trend_df)
-        follow_trades = summary.get("Upside Follow", 0) + summary.get("Downside Follow", 0)
+        follow_trades = upside_follow + downside_follow
         win_rate = (follow_trades / total_trades * 100) if total_trades > 0 else 0
 
         # -----------------------------
         # Save Backtest file with Highlights
         # -----------------------------
         backtest_file = os.path.join(backtest_dir, f"{symbol}_Backtest.xlsx")
-        trend_df.to_excel(backtest_file, index=False, sheet_name="Backtest")
-
-        wb = load_workbook(backtest_file)
-        ws = wb["Backtest"]
-
-        green_fill = PatternFill(start_color="99FF99", end_color="99FF99", fill_type="solid")
-        red_fill = PatternFill(start_color="FF9999", end_color="FF9999", fill_type="solid")
-
-        # Find column indices
-        pnl_col = None
-        capital_col = None
-        for col in range(1, ws.max_column + 1):
-            header = ws.cell(row=1, column=col).value
-            if header == "PnL":
-                pnl_col = col
-            elif header == "Capital":
-                capital_col = col
-
-        # Apply highlights
-        for row_num in range(2, ws.max_row + 1):
-            # PnL highlight
-            if pnl_col:
-                pnl_value = ws.cell(row=row_num, column=pnl_col).value
-                if pnl_value is not None:
-                    ws.cell(row=row_num, column=pnl_col).fill = green_fill if pnl_value > 0 else red_fill
-            # Capital highlight
-            if capital_col:
-                capital_value = ws.cell(row=row_num, column=capital_col).value
-                prev_capital = initial_capital if row_num == 2 else ws.cell(row=row_num - 1, column=capital_col).value
-                if capital_value is not None:
-                    ws.cell(row=row_num, column=capital_col).fill = green_fill if capital_value > prev_capital else red_fill
-
-        wb.save(backtest_file)
+        wb = xlsxwriter.Workbook(backtest_file, {"constant_memory": True})
+        ws = wb.add_worksheet("Backtest")
+
+        green_fmt = wb.add_format(green_fill)
+        red_fmt = wb.add_format(red_fill)
+        date_fmt = wb.add_format({"num_format": "yyyy-mm-dd"})
+
+        # Single pass, row by row: Capital highlight is chosen while writing
+        ws.write_row(0, 0, trend_df.columns)
+        prev_capital = initial_capital
+        for r, row in enumerate(trend_df.itertuples(index=False), start=1):
+            ws.write_datetime(r, 0, row.Date, date_fmt)
+            ws.write_string(r, 1, row.Trend)
+            if not np.isnan(row.Entry):
+                ws.write_number(r, 2, row.Entry)
+            ws.write_number(r, 3, row.Exit)
+            ws.write_number(r, 4, row.Quantity)
+            ws.write_number(r, 5, row.PnL)
+            ws.write_number(r, 6, row.Capital, green_fmt if row.Capital > prev_capital else red_fmt)
+            prev_capital = row.Capital
+
+        # PnL highlight as conditional formatting rules (profit green, otherwise red)
+        last_row = len(trend_df)
+        ws.conditional_format(1, 5, last_row, 5,
+                              {"type": "cell", "criteria": ">", "value": 0, "format": green_fmt})
+        ws.conditional_format(1, 5, last_row, 5,
+                              {"type": "cell", "criteria": "<=", "value": 0, "format": red_fmt})
+
+        wb.close()
         print(f"📊 Backtest saved with PnL & Capital highlights → {backtest_file}")
 
         # -----------------------------
         # Master Results
         # -----------------------------
-        master_results.append({
+        return {
             "Ticker": symbol,
             "Total Trades": total_trades,
-            "Upside Follow": summary.get("Upside Follow", 0),
-            "Downside Follow": summary.get("Downside Follow", 0),
-            "Upside Fake": summary.get("Upside Fake", 0),
-            "Downside Fake": summary.get("Downside Fake", 0),
+            "Upside Follow": upside_follow,
+            "Downside Follow": downside_follow,
+            "Upside Fake": upside_fake,
+            "Downside Fake": downside_fake,
             "Win Rate %": round(win_rate, 2),
             "Final Capital": round(final_capital, 2),
             "Profit": round(total_profit, 2),
             "Total Profit (Year End)": round(final_capital - initial_capital, 2)  # <-- Added
-        })
+        }
 
     except Exception as e:
         print(f"❌ Error for {symbol}: {e}")
+        return None
+
+
+if __name__ == "__main__":
+    # -----------------------------
+    # Load Tickers
+    # -----------------------------
+    tickers_df = pd.read_excel(ticker_file, engine="calamine")
+    tickers = tickers_df.iloc[:, 0].dropna().tolist()
+
+    # -----------------------------
+    # Load Cached Downloads / Fetch the Rest (threaded batch)
+    # -----------------------------
+    prefetched = {}
+    to_fetch = []
+    # Cache files are keyed by the download config so changing dates/interval never reuses old data
+    cache_tag = f"{interval}_{start_date}_{end_date}"
+    for symbol in tickers:
+        cache_path = os.path.join(download_dir, f"{symbol}_{cache_tag}.parquet")
+        if os.path.exists(cache_path) and os.path.getmtime(cache_path) > time.time() - cache_max_age:
+            try:
+                prefetched[symbol] = pd.read_parquet(cache_path).rename_axis("Datetime")
+                continue
+            except Exception as e:
+                print(f"⚠️ Unreadable cache for {symbol} ({e}), re-downloading...")
+        to_fetch.append(symbol)
+
+    print(f"\n📦 {len(prefetched)} tickers loaded from cache")
+
+    if to_fetch:
+        print(f"\n📥 Fetching data for {len(to_fetch)} tickers...")
+        all_data = yf.download(
+            to_fetch,
+            start=start_date,
+            end=end_date,
+            interval=interval,
+            auto_adjust=True,
+            group_by="ticker",
+            threads=True
+        )
 
-# -----------------------------
-# Save Master Summary + Highlights
-# -----------------------------
-if master_results:
-    master_df = pd.DataFrame(master_results)
-
-    best_stock = master_df.loc[master_df["Final Capital"].idxmax()]
-    worst_stock = master_df.loc[master_df["Final Capital"].idxmin()]
-
-    with pd.ExcelWriter(summary_file, engine="openpyxl") as writer:
-        master_df.to_excel(writer, index=False, sheet_name="Summary")
-        ws = writer.book["Summary"]
-
-        green_fill = PatternFill(start_color="99FF99", end_color="99FF99", fill_type="solid")
-        red_fill = PatternFill(start_color="FF9999", end_color="FF9999", fill_type="solid")
-
-        # Highlight Win Rate %
-        win_rate_col = None
-        for col in range(1, ws.max_column + 1):
-            if ws.cell(row=1, column=col).value == "Win Rate %":
-                win_rate_col = col
-                break
-
-        if win_rate_col:
-            for row in range(2, ws.max_row + 1):
-                value = ws.cell(row=row, column=win_rate_col).value
-                if value is not None:
-                    if value > 60:
-                        ws.cell(row=row, column=win_rate_col).fill = green_fill
-                    elif value < 40:
-                        ws.cell(row=row, column=win_rate_col).fill = red_fill
-
-        # Append Best & Worst performers
-        ws.append([])
-        ws.append([
+        fetched = set(all_data.columns.get_level_values(0))
+        for symbol in to_fetch:
+            if symbol not in fetched:
+                continue
+            # A failed symbol in the batch leaves the combined index unnamed; name it explicitly
+            data = all_data[symbol].dropna(how="all").rename_axis("Datetime")
+            if data.empty:
+                continue
+            cache_path = os.path.join(download_dir, f"{symbol}_{cache_tag}.parquet")
+            cache_tmp = cache_path + ".tmp"
+            data.to_parquet(cache_tmp, compression="zstd")
+            os.replace(cache_tmp, cache_path)  # atomic: a killed write never leaves a "fresh" partial file
+            prefetched[symbol] = data
+
+    # -----------------------------
+    # Process Tickers in Parallel
+    # -----------------------------
+    for symbol in tickers:
+        if symbol not in prefetched:
+            print(f"⚠️ No data for {symbol}, skipping...")
+
+    # Compile (or load from the on-disk cache) once before the workers start,
+    # so they reuse the cached kernel instead of each JIT-compiling it
+    run_backtest(np.zeros(1), np.zeros(1), np.zeros(1), 0.0)
+
+    jobs = [(symbol, prefetched[symbol]) for symbol in tickers if symbol in prefetched]
+    with mp.Pool(min(8, os.cpu_count() or 1)) as pool:
+        results = pool.starmap(process_ticker, jobs)
+
+    master_results = [row for row in results if row is not None]
+
+    # -----------------------------
+    # Save Master Summary + Highlights
+    # -----------------------------
+    if master_results:
+        master_df = pd.DataFrame(master_results)
+
+        final_capitals = master_df["Final Capital"].to_numpy()
+        best_stock = master_df.iloc[final_capitals.argmax()]
+        worst_stock = master_df.iloc[final_capitals.argmin()]
+
+        wb = xlsxwriter.Workbook(summary_file, {"constant_memory": True})
+        ws = wb.add_worksheet("Summary")
+
+        green_fmt = wb.add_format(green_fill)
+        red_fmt = wb.add_format(red_fill)
+
+        ws.write_row(0, 0, master_df.columns)
+        for r, row in enumerate(master_df.itertuples(index=False), start=1):
+            ws.write_row(r, 0, row)
+
+        # Highlight Win Rate % with conditional formatting rules
+        win_rate_col = master_df.columns.get_loc("Win Rate %")
+        last_row = len(master_df)
+        ws.conditional_format(1, win_rate_col, last_row, win_rate_col,
+                              {"type": "cell", "criteria": ">", "value": 60, "format": green_fmt})
+        ws.conditional_format(1, win_rate_col, last_row, win_rate_col,
+                              {"type": "cell", "criteria": "<", "value": 40, "format": red_fmt})
+
+        # Append Best & Worst performers (after one blank row)
+        r = len(master_df) + 2
+        ws.write_row(r, 0, [
             "Best Performer",
             best_stock["Ticker"],
             f"Capital: {best_stock['Final Capital']}",
@@ -227,7 +321,7 @@ if master_results:
             f"Win Rate: {best_stock['Win Rate %']}%",
             f"Total Profit (Year End): {best_stock['Total Profit (Year End)']}"  # <-- Added
         ])
-        ws.append([
+        ws.write_row(r + 1, 0, [
             "Worst Performer",
             worst_stock["Ticker"],
             f"Capital: {worst_stock['Final Capital']}",
@@ -236,14 +330,16 @@ if master_results:
             f"Total Profit (Year End): {worst_stock['Total Profit (Year End)']}"  # <-- Added
         ])
 
-    print(f"\n✅ Master Summary saved → {summary_file}")
-
-    # Console Summary
-    print("\n================= 📊 SUMMARY REPORT =================")
-    print(master_df[["Ticker", "Total Trades", "Win Rate %", "Final Capital", "Profit", "Total Profit (Year End)"]].to_string(index=False))
-    print("------------------------------------------------------")
-    print(f"🏆 Best Performer : {best_stock['Ticker']} | Capital: ₹{best_stock['Final Capital']} | Profit: ₹{best_stock['Profit']} | Total Profit: ₹{best_stock['Total Profit (Year End)']} | Win Rate: {best_stock['Win Rate %']}%")
-    print(f"⚠️ Worst Performer: {worst_stock['Ticker']} | Capital: ₹{worst_stock['Final Capital']} | Profit: ₹{worst_stock['Profit']} | Total Profit: ₹{worst_stock['Total Profit (Year End)']} | Win Rate: {worst_stock['Win Rate %']}%")
-    print("======================================================")
-else:
-    print("⚠️ No tickers processed successfully. Master Summary not created.")
+        wb.close()
+
+        print(f"\n✅ Master Summary saved → {summary_file}")
+
+        # Console Summary
+        print("\n================= 📊 SUMMARY REPORT =================")
+        print(master_df[["Ticker", "Total Trades", "Win Rate %", "Final Capital", "Profit", "Total Profit (Year End)"]].to_string(index=False))
+        print("------------------------------------------------------")
+        print(f"🏆 Best Performer : {best_stock['Ticker']} | Capital: ₹{best_stock['Final Capital']} | Profit: ₹{best_stock['Profit']} | Total Profit: ₹{best_stock['Total Profit (Year End)']} | Win Rate: {best_stock['Win Rate %']}%")
+        print(f"⚠️ Worst Performer: {worst_stock['Ticker']} | Capital: ₹{worst_stock['Final Capital']} | Profit: ₹{worst_stock['Profit']} | Total Profit: ₹{worst_stock['Total Profit (Year End)']} | Win Rate: {worst_stock['Win Rate %']}%")
+        print("======================================================")
+    else:
+        print("⚠️ No tickers processed successfully. Master Summary not created.")
@@ -1,9 +1,12 @@
 import pandas as pd
+import matplotlib
+matplotlib.use('Agg')  # headless backend: render straight to file, no GUI window
 import matplotlib.pyplot as plt
 
 # Read Excel file
 file_path = 'Master_Summary.xlsx'
-df = pd.read_excel(file_path)
+chart_file = 'summary_bar.png'
+df = pd.read_excel(file_path, engine='calamine')
 
 # Ensure Ticker is string
 df['Ticker'] = df['Ticker'].astype(str)
@@ -28,8 +31,10 @@ ax.set_title('Initial Capital vs Total Profit for All Stocks')
 ax.legend()
 
 plt.tight_layout()
-plt.show()
+fig.savefig(chart_file, dpi=120)
+plt.close(fig)
 
 print(f"Initial Capital: ₹{initial_capital}")
 print(f"Total Profit from all stocks: ₹{total_profit}")
 print(f"Total Capital at Year End: ₹{total_final_capital}")
+print(f"Chart saved → {chart_file}")